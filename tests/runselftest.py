@@ -60,6 +60,11 @@ try:
 except ImportError:
     h5py = None
 
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
 if 'VEUSZ_INPLACE_TEST' in os.environ:
     sys.path.append(os.getcwd())
     os.environ['VEUSZ_RESOURCE_DIR'] = os.getcwd()
@@ -236,6 +241,7 @@ def runTests(test_saves=False, test_unlink=False):
 
         if ( (base[:5] == 'hdf5_' and h5py is None) or
              (base[:5] == 'fits_' and pyfits is None) or
+             (base[:8] == 'numexpr_' and numexpr is None) or
              (ext == '.vszh5' and h5py is None) ):
             print(" SKIPPED: missing support module")
             skipped_support += 1
@@ -0,0 +1,34 @@
+import sys
+
+import veusz.qtall as qt
+import veusz.document as document
+import veusz.widgets
+
+def main(outfile):
+    # check surface grid positions and colour cell centres are in
+    # data coordinates on log axes, including for very large values
+    app = qt.QApplication([])
+
+    doc = document.Document()
+    ifc = document.CommandInterface(doc)
+
+    ifc.To(ifc.Add('page'))
+    ifc.To(ifc.Add('scene3d'))
+    ifc.To(ifc.Add('graph3d'))
+    ifc.Set('x/log', True)
+    ifc.Set('x/min', 1e200)
+    ifc.Set('x/max', 1e300)
+    ifc.Set('y/min', 0.)
+    ifc.Set('y/max', 1.)
+    name = ifc.Add(
+        'function3d', mode='z=fn(x,y)', surfacesteps=3,
+        fnz='y', fncolor='log10(x)/1000')
+    fn = doc.resolveWidgetPath(ifc.currentwidget, name)
+
+    height, steps1, steps2, axidx, var, colors = fn.getGridVals()
+    with open(outfile, 'w') as f:
+        f.write(' '.join(['%.6g' % v for v in steps1]) + '\n')
+        f.write(' '.join(['%.6g' % v for v in colors[:,0]*1000]) + '\n')
+
+if __name__ == '__main__':
+    main(sys.argv[1])
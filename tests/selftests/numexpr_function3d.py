@@ -0,0 +1,50 @@
+import sys
+
+import numpy as N
+
+import veusz.qtall as qt
+import veusz.document as document
+import veusz.widgets
+from veusz.widgets import function3d
+
+def main(outfile):
+    # check that function3d evaluates expressions with numexpr only
+    # when it gives the same results as python
+    if function3d.numexpr is None:
+        raise RuntimeError('numexpr is required for this test')
+
+    app = qt.QApplication([])
+
+    doc = document.Document()
+    ifc = document.CommandInterface(doc)
+
+    # redefine a numexpr function, and use an integer constant which
+    # overflows as int64
+    ifc.AddCustom('function', 'sin(x)', '100*x')
+    ifc.AddCustom('constant', 'n', '10')
+
+    ifc.To(ifc.Add('page'))
+    ifc.To(ifc.Add('scene3d'))
+    ifc.To(ifc.Add('graph3d'))
+    name = ifc.Add(
+        'function3d', mode='x,y,z=fns(t)', linesteps=3,
+        fnx='sin(t)', fny='t*n**20', fnz='t')
+    fn = doc.resolveWidgetPath(ifc.currentwidget, name)
+
+    # which expressions numexpr is allowed to evaluate
+    env = doc.evaluate.context.copy()
+    env['t'] = env['x'] = env['y'] = N.linspace(0, 1, 3)
+    compat = []
+    for expr in ('x**2+y**2', '(x**2+y**2)/20', 'sin(t)', 't*n**20'):
+        comp = doc.evaluate.compileCheckedExpression(expr)
+        compat.append('%s %s' % (
+            expr, function3d._numexprCompatible(expr, comp, env)))
+
+    with open(outfile, 'w') as f:
+        for vals in fn.getLineVals()[:3]:
+            f.write(' '.join(['%.6g' % v for v in vals]) + '\n')
+        for line in compat:
+            f.write(line + '\n')
+
+if __name__ == '__main__':
+    main(sys.argv[1])
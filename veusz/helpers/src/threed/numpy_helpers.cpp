@@ -55,10 +55,8 @@ ValVector numpyToValVector(PyObject* obj)
   const double* data = (double*)PyArray_DATA(arrayobj);
   unsigned dim = PyArray_DIMS(arrayobj)[0];
 
-  ValVector out;
-  out.reserve(dim);
-  for(unsigned i=0; i<dim; ++i)
-    out.push_back(data[i]);
+  // copy contiguous data in one go
+  ValVector out(data, data+dim);
 
   Py_DECREF((PyObject*)arrayobj);
 
@@ -18,6 +18,8 @@
 
 """3D function plotting widget."""
 
+import ast
+
 import numpy as N
 
 from .. import qtall as qt
@@ -28,10 +30,59 @@ from ..helpers import threed
 
 from . import plotters3d
 
+try:
+    import numexpr
+    from numexpr.expressions import functions as numexpr_functions
+except ImportError:
+    numexpr = None
+
 def _(text, disambiguation=None, context='Function3D'):
     """Translate text."""
     return qt.QCoreApplication.translate(context, text, disambiguation)
 
+def _isInteger(val):
+    """Is val an integer (which numexpr would convert to int64)?"""
+    return isinstance(val, (int, N.integer))
+
+def _isIntegerNode(node, env):
+    """Does the ast node give an integer when evaluated in env?"""
+    if isinstance(node, ast.Constant):
+        return _isInteger(node.value)
+    elif isinstance(node, ast.Name):
+        return _isInteger(env.get(node.id))
+    elif isinstance(node, ast.BinOp):
+        return (
+            _isIntegerNode(node.left, env) and
+            _isIntegerNode(node.right, env) )
+    elif isinstance(node, ast.UnaryOp):
+        return _isIntegerNode(node.operand, env)
+    return False
+
+def _numexprCompatible(expr, comp, env):
+    """Will numexpr give the same result as python for expr in env?
+
+    comp is the compiled expression.
+
+    numexpr uses its own versions of functions such as sin and log,
+    ignoring any other definitions of these names in env. It also
+    does integer arithmetic in int64, so operations combining only
+    integers (e.g. n**20) can overflow, unlike in python.
+    """
+    for name in comp.co_names:
+        if ( name in numexpr_functions and
+             env.get(name) is not getattr(N, name, None) ):
+            return False
+
+    for node in ast.walk(ast.parse(expr, mode='eval')):
+        # negative integer literals (e.g. x**-1) are fine
+        if isinstance(node, ast.UnaryOp) and isinstance(
+                node.operand, ast.Constant):
+            continue
+        if ( isinstance(node, (ast.BinOp, ast.UnaryOp)) and
+             _isIntegerNode(node, env) ):
+            return False
+    return True
+
 class FunctionSurface(setting.Surface3DWColorMap):
     def __init__(self, *args, **argsv):
         setting.Surface3DWColorMap.__init__(self, *args, **argsv)
@@ -50,6 +101,21 @@ class Function3D(plotters3d.GenericPlotter3D):
     description=_('3D function')
     allowusercreation=True
 
+    def __init__(self, parent, name=None):
+        plotters3d.GenericPlotter3D.__init__(self, parent, name=name)
+
+        # cached results of getLineVals and getGridVals, with the keys
+        # they were computed for
+        self.linevalscache = (None, None)
+        self.gridvalscache = (None, None)
+        # cached logical coordinates of grid values
+        self.gridlogicalcache = (None, None)
+
+        # expressions which numexpr could not evaluate, reset when
+        # the document changes
+        self.numexprfailed = set()
+        self.numexprfailedchangeset = -1
+
     # list of the supported modes
     _modes = [
         'x=fn(y,z)', 'y=fn(x,z)', 'z=fn(x,y)',
@@ -86,6 +152,14 @@ class Function3D(plotters3d.GenericPlotter3D):
         'x,z=fns(y)': ('x', 'z', 'y'),
     }
 
+    # for surface modes, the dependent variable, the two grid
+    # variables and the indices of these into the axes
+    _gridmap = {
+        'x=fn(y,z)': ('x', 'y', 'z', (0, 1, 2)),
+        'y=fn(x,z)': ('y', 'z', 'x', (1, 2, 0)),
+        'z=fn(x,y)': ('z', 'x', 'y', (2, 0, 1)),
+    }
+
     @staticmethod
     def _fnsetnshowhide(v):
         """Return which function settings to show or hide depending on
@@ -178,8 +252,74 @@ class Function3D(plotters3d.GenericPlotter3D):
         requires = self._requires[s.mode]
         return [(v[0], getattr(s, v[1])) for v in requires]
 
+    def _valsCacheKey(self, axvars):
+        """Return a key for caching evaluated values.
+
+        axvars are the variables ('x', 'y' or 'z') of the axes used as
+        inputs. None is returned if an axis is missing.
+        """
+        axkey = []
+        for var in axvars:
+            axis = self.fetchAxis(var)
+            if axis is None:
+                return None
+            axkey.append((axis.getPlottedRange(), axis.settings.log))
+        return (self.document.changeset, tuple(axkey))
+
+    def evalExpr(self, expr, comp, env, out):
+        """Evaluate expression expr, compiled as comp, in environment env.
+
+        The result is written into the array out, which is returned.
+
+        numexpr is used if it is available and supports the
+        expression, as it avoids temporary arrays and uses multiple
+        threads. Otherwise the compiled expression is evaluated by
+        python. numexpr caches its compiled expressions itself, but
+        failures are remembered here so they are not retried until
+        the document changes.
+
+        Constant expressions, which reference no names, are evaluated
+        directly by python and broadcast into out. Python is also used
+        if numexpr could give a different result (see
+        _numexprCompatible).
+        """
+        if self.numexprfailedchangeset != self.document.changeset:
+            self.numexprfailedchangeset = self.document.changeset
+            self.numexprfailed.clear()
+
+        if ( numexpr is not None and comp.co_names and
+             expr not in self.numexprfailed and
+             _numexprCompatible(expr, comp, env) ):
+            try:
+                return numexpr.evaluate(
+                    expr, local_dict=env, global_dict={}, out=out)
+            except Exception:
+                # unsupported function or syntax
+                self.numexprfailed.add(expr)
+
+        out[...] = eval(comp, env)
+        return out
+
     def getLineVals(self):
-        """Get vals for line plot by evaluating function."""
+        """Get vals for line plot by evaluating function.
+
+        The values are cached, as they are requested several times
+        when computing axis ranges and drawing.
+        """
+        mode = self.settings.mode
+        if mode == 'x,y,z=fns(t)':
+            key = self._valsCacheKey(())
+        else:
+            key = self._valsCacheKey(self._varmap[mode][2:])
+
+        if key is not None and self.linevalscache[0] == key:
+            return self.linevalscache[1]
+        retn = self.calcLineVals()
+        self.linevalscache = (key, retn)
+        return retn
+
+    def calcLineVals(self):
+        """Evaluate function to get values for line plot."""
         s = self.settings
         mode = s.mode
 
@@ -196,21 +336,26 @@ class Function3D(plotters3d.GenericPlotter3D):
             # evaluate each expression
             env = self.document.evaluate.context.copy()
             env['t'] = N.linspace(0, 1, s.linesteps)
-            zeros = N.zeros(s.linesteps, dtype=N.float64)
+            # results are written into rows of a single array
+            valsx, valsy, valsz = N.empty((3, s.linesteps), dtype=N.float64)
             try:
-                valsx = eval(xcomp, env) + zeros
-                valsy = eval(ycomp, env) + zeros
-                valsz = eval(zcomp, env) + zeros
+                self.evalExpr(s.fnx, xcomp, env, out=valsx)
+                self.evalExpr(s.fny, ycomp, env, out=valsy)
+                self.evalExpr(s.fnz, zcomp, env, out=valsz)
             except:
                 # something wrong in the evaluation
                 return None
 
             fncolor = s.fncolor.strip()
             if fncolor:
-                fncolor = self.document.evaluate.compileCheckedExpression(
+                compcolor = self.document.evaluate.compileCheckedExpression(
                     fncolor)
+                if compcolor is None:
+                    return None
                 try:
-                    valscolor = eval(fncolor, env) + zeros
+                    valscolor = self.evalExpr(
+                        fncolor, compcolor, env,
+                        out=N.empty(s.linesteps, dtype=N.float64))
                 except:
                     return None
             else:
@@ -225,46 +370,56 @@ class Function3D(plotters3d.GenericPlotter3D):
             if not fns[0] or not fns[1]:
                 return None
 
+            comp1 = self.document.evaluate.compileCheckedExpression(fns[0])
+            comp2 = self.document.evaluate.compileCheckedExpression(fns[1])
+            if comp1 is None or comp2 is None:
+                return None
+
             # get points to evaluate functions over
             axis = self.fetchAxis(var[2])
             if not axis:
                 return
             arange = axis.getPlottedRange()
+
+            # x, y and z values are rows of a single array
+            idxs = ('x', 'y', 'z')
+            vals = N.empty((3, s.linesteps), dtype=N.float64)
+            vals1 = vals[idxs.index(var[0])]
+            vals2 = vals[idxs.index(var[1])]
+            evalpts = vals[idxs.index(var[2])]
+
             if axis.settings.log:
-                evalpts = N.logspace(
+                evalpts[:] = N.logspace(
                     N.log10(arange[0]), N.log10(arange[1]), s.linesteps)
             else:
-                evalpts = N.linspace(arange[0], arange[1], s.linesteps)
+                evalpts[:] = N.linspace(arange[0], arange[1], s.linesteps)
 
             # evaluate expressions
             env = self.document.evaluate.context.copy()
             env[var[2]] = evalpts
-            zeros = N.zeros(s.linesteps, dtype=N.float64)
             try:
-                vals1 = eval(fns[0], env) + zeros
-                vals2 = eval(fns[1], env) + zeros
+                self.evalExpr(fns[0], comp1, env, out=vals1)
+                self.evalExpr(fns[1], comp2, env, out=vals2)
             except:
                 # something wrong in the evaluation
                 return None
 
             fncolor = s.fncolor.strip()
             if fncolor:
-                fncolor = self.document.evaluate.compileCheckedExpression(
+                compcolor = self.document.evaluate.compileCheckedExpression(
                     fncolor)
+                if compcolor is None:
+                    return None
                 try:
-                    valscolor = eval(fncolor, env) + zeros
+                    valscolor = self.evalExpr(
+                        fncolor, compcolor, env,
+                        out=N.empty(s.linesteps, dtype=N.float64))
                 except:
                     return None
             else:
                 valscolor = None
 
-            # assign correct output points
-            retn = [None]*4
-            idxs = ('x', 'y', 'z')
-            retn[idxs.index(var[0])] = vals1
-            retn[idxs.index(var[1])] = vals2
-            retn[idxs.index(var[2])] = evalpts
-            retn[3] = valscolor
+            retn = (vals[0], vals[1], vals[2], valscolor)
 
         return retn
 
@@ -273,16 +428,44 @@ class Function3D(plotters3d.GenericPlotter3D):
 
         Return steps1, steps2, height, axidx, depvariable
         axidx are the indices into the axes for height, step1, step2
+
+        The values are cached in the same way as getLineVals.
         """
+        return self.getGridValsWithKey()[1]
 
-        s = self.settings
-        mode = s.mode
+    def getGridValsWithKey(self):
+        """Get values for 2D grid, as returned by getGridVals.
+
+        Returns key, values, where key is the cache key for the values
+        (or None if they cannot be cached).
+        """
+        key = self._valsCacheKey(self._gridmap[self.settings.mode][1:3])
+        if key is None or self.gridvalscache[0] != key:
+            self.gridvalscache = (key, self.calcGridVals())
+        return self.gridvalscache
+
+    def evalGridExpr(self, expr, comp, env, varnames, grids):
+        """Evaluate expression over a grid.
+
+        varnames are the names of the two grid variables, and grids are
+        the values, which broadcast against each other to form the
+        grid. If the evaluation fails, the expression is retried with
+        full-sized grids, as some expressions depend on the shape of
+        the grid variables (e.g. len(x) or gradient(x)).
+        """
+        out = N.empty(N.broadcast(*grids).shape, dtype=N.float64)
+        env[varnames[0]], env[varnames[1]] = grids
+        try:
+            return self.evalExpr(expr, comp, env, out=out)
+        except Exception:
+            env[varnames[0]], env[varnames[1]] = N.broadcast_arrays(*grids)
+            return self.evalExpr(expr, comp, env, out=out)
 
-        var, ovar1, ovar2, axidx = {
-            'x=fn(y,z)': ('x', 'y', 'z', (0, 1, 2)),
-            'y=fn(x,z)': ('y', 'z', 'x', (1, 2, 0)),
-            'z=fn(x,y)': ('z', 'x', 'y', (2, 0, 1)),
-        }[mode]
+    def calcGridVals(self):
+        """Evaluate function over 2D grid."""
+
+        s = self.settings
+        var, ovar1, ovar2, axidx = self._gridmap[s.mode]
 
         axes = self.fetchAxes()
         if axes is None:
@@ -295,39 +478,37 @@ class Function3D(plotters3d.GenericPlotter3D):
         steps = s.surfacesteps
         logax1, logax2 = ax1.settings.log, ax2.settings.log
 
-        # convert log ranges to linear temporarily
+        # positions along each axis
         if logax1:
-            pr1 = N.log(pr1)
+            steps1 = N.logspace(N.log10(pr1[0]), N.log10(pr1[1]), steps)
+        else:
+            steps1 = N.linspace(pr1[0], pr1[1], steps)
         if logax2:
-            pr2 = N.log(pr2)
+            steps2 = N.logspace(N.log10(pr2[0]), N.log10(pr2[1]), steps)
+        else:
+            steps2 = N.linspace(pr2[0], pr2[1], steps)
 
-        # set variables in environment
-        grid1, grid2 = N.indices((steps, steps))
-        del1 = (pr1[1]-pr1[0])/(steps-1.)
-        steps1 = N.arange(steps)*del1 + pr1[0]
-        grid1 = grid1*del1 + pr1[0]
-        del2 = (pr2[1]-pr2[0])/(steps-1.)
-        steps2 = N.arange(steps)*del2 + pr2[0]
-        grid2 = grid2*del2 + pr2[0]
+        # the grid variables are 1D arrays along different dimensions
+        # which broadcast against each other, rather than full 2D grids
+        grid1 = steps1[:,N.newaxis]
+        grid2 = steps2[N.newaxis,:]
 
+        # colors are evaluated at the centres of the grid cells
+        # (geometric on log axes, avoiding overflow in the product)
         fncolor = s.fncolor.strip()
         if fncolor:
-            colgrid1 = 0.5*(grid1[1:,1:]+grid1[:-1,:-1])
-            colgrid2 = 0.5*(grid2[1:,1:]+grid2[:-1,:-1])
             if logax1:
-                colgrid1 = N.exp(colgrid1)
+                colsteps1 = N.sqrt(steps1[1:])*N.sqrt(steps1[:-1])
+            else:
+                colsteps1 = 0.5*(steps1[1:]+steps1[:-1])
             if logax2:
-                colgrid2 = N.exp(colgrid2)
-
-        # convert back to log
-        if logax1:
-            grid1 = N.exp(grid1)
-        if logax2:
-            grid2 = N.exp(grid2)
+                colsteps2 = N.sqrt(steps2[1:])*N.sqrt(steps2[:-1])
+            else:
+                colsteps2 = 0.5*(steps2[1:]+steps2[:-1])
+            colgrid1 = colsteps1[:,N.newaxis]
+            colgrid2 = colsteps2[N.newaxis,:]
 
         env = self.document.evaluate.context.copy()
-        env[ovar1] = grid1
-        env[ovar2] = grid2
 
         fn = getattr(s, 'fn%s' % var)  # get function from user
         if not fn:
@@ -337,7 +518,8 @@ class Function3D(plotters3d.GenericPlotter3D):
             return None
 
         try:
-            height = eval(comp, env) + N.zeros(grid1.shape, dtype=N.float64)
+            height = self.evalGridExpr(
+                fn, comp, env, (ovar1, ovar2), (grid1, grid2))
         except Exception:
             # something wrong in the evaluation
             return None
@@ -347,12 +529,11 @@ class Function3D(plotters3d.GenericPlotter3D):
                 fncolor)
             if not compcolor:
                 return
-            env[ovar1] = colgrid1
-            env[ovar2] = colgrid2
 
             try:
-                colors = eval(compcolor, env) + N.zeros(
-                    colgrid1.shape, dtype=N.float64)
+                colors = self.evalGridExpr(
+                    fncolor, compcolor, env, (ovar1, ovar2),
+                    (colgrid1, colgrid2))
             except Exception:
                 # something wrong in the evaluation
                 return None
@@ -397,10 +578,16 @@ class Function3D(plotters3d.GenericPlotter3D):
                 return
             coord = height
 
-        finite = coord[N.isfinite(coord)]
-        if len(finite) > 0:
-            axrange[0] = min(axrange[0], finite.min())
-            axrange[1] = max(axrange[1], finite.max())
+        if coord.size == 0:
+            return
+        finite = N.isfinite(coord)
+        if not finite.all():
+            # only copy the values if some need removing
+            if not finite.any():
+                return
+            coord = coord[finite]
+        axrange[0] = min(axrange[0], coord.min())
+        axrange[1] = max(axrange[1], coord.max())
 
     def updatePropColorMap(self, prop, setn, colorvals):
         """Update line/surface properties given color map values.
@@ -415,15 +602,38 @@ class Function3D(plotters3d.GenericPlotter3D):
             cmap, 'linear', color2d, 0., 1., setn.transparency)
         prop.setRGBs(colorimg)
 
+    def getGridLogicalCoords(self, axes, valskey, gridvals):
+        """Convert grid values from getGridVals to logical coordinates.
+
+        valskey is the cache key for gridvals returned by
+        getGridValsWithKey. Returns lheight, lsteps1, lsteps2. The
+        result is cached while the grid values and plotted axis ranges
+        are unchanged.
+        """
+        height, steps1, steps2, axidx = gridvals[:4]
+
+        key = valskey
+        if key is not None:
+            key = (key, tuple(axes[i].getPlottedRange() for i in axidx))
+            if self.gridlogicalcache[0] == key:
+                return self.gridlogicalcache[1]
+
+        lvals = (
+            axes[axidx[0]].dataToLogicalCoords(height),
+            axes[axidx[1]].dataToLogicalCoords(steps1),
+            axes[axidx[2]].dataToLogicalCoords(steps2),
+        )
+        self.gridlogicalcache = (key, lvals)
+        return lvals
+
     def dataDrawSurface(self, painter, axes, container):
         """Draw a surface plot."""
-        retn = self.getGridVals()
+        valskey, retn = self.getGridValsWithKey()
         if not retn:
             return
         height, steps1, steps2, axidx, depvar, colors = retn
-        lheight = axes[axidx[0]].dataToLogicalCoords(height)
-        lsteps1 = axes[axidx[1]].dataToLogicalCoords(steps1)
-        lsteps2 = axes[axidx[2]].dataToLogicalCoords(steps2)
+        lheight, lsteps1, lsteps2 = self.getGridLogicalCoords(
+            axes, valskey, retn)
 
         # draw grid over each axis
         surfprop = lineprop = None